@@ -0,0 +1,50 @@
+"""Einmaliger Export des SAM-Bild-Encoders nach ONNX.
+
+Das Ergebnis (models/sam_vit_h_encoder.onnx) nutzt testApp.py, wenn die App mit
+SAM_ONNX_ENCODER=1 gestartet wird. Zur Laufzeit wählt ONNX Runtime je nach Installation
+TensorRT (FP16, Engine-Cache unter models/trt_cache), CUDA, OpenVINO oder die CPU.
+onnxruntime steht bewusst nicht in requirements.txt, da das passende Paket von der
+Hardware abhängt: pip install onnxruntime-gpu (CUDA/TensorRT), onnxruntime-openvino
+oder onnxruntime (CPU).
+
+Aufruf:
+    python export_sam_onnx.py --checkpoint sam_vit_h_4b8939.pth
+"""
+import argparse
+import os
+
+import torch
+from segment_anything import sam_model_registry
+
+
+def export_encoder(checkpoint, output, model_type="vit_h", opset=17):
+    """Traced den Bild-Encoder mit einem Dummy-Bild und schreibt ihn als ONNX-Modell"""
+    sam = sam_model_registry[model_type](checkpoint=checkpoint)
+    encoder = sam.image_encoder.eval()
+    dummy = torch.randn(1, 3, encoder.img_size, encoder.img_size)
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    # ViT-H ist größer als 2 GB: torch legt die Gewichte als externe Daten neben die .onnx-Datei
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            dummy,
+            output,
+            opset_version=opset,
+            input_names=["image"],
+            output_names=["image_embeddings"],
+            do_constant_folding=True
+        )
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SAM-Bild-Encoder nach ONNX exportieren")
+    parser.add_argument("--checkpoint", required=True, help="Pfad zum SAM-Checkpoint (.pth)")
+    parser.add_argument("--model-type", default="vit_h", help="SAM-Modelltyp (vit_h, vit_l, vit_b)")
+    parser.add_argument("--output", default=os.path.join("models", "sam_vit_h_encoder.onnx"))
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    path = export_encoder(args.checkpoint, args.output, args.model_type, args.opset)
+    print(f"Encoder exportiert: {path}")
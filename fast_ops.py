@@ -0,0 +1,32 @@
+"""Numba-Kernel für pixelweise Operationen der App"""
+import numpy as np
+from numba import njit
+
+
+# Ohne parallel=True: der Kernel wird aus mehreren Threads (Sessions, Executor) gleichzeitig
+# aufgerufen, und Numbas workqueue-Threading-Layer bricht dabei den ganzen Prozess ab
+@njit(cache=True)
+def blend_mask(rgb, mask, colors, alpha, out):
+    """Färbt mask über die Farbtabelle colors (N, 3) ein und blendet sie mit alpha über rgb nach out"""
+    height, width = mask.shape
+    max_value = max(mask.max(), 1)
+    n_colors = colors.shape[0]
+    for i in range(height):
+        for j in range(width):
+            value = mask[i, j]
+            if value > 0:
+                k = value * (n_colors - 1) // max_value
+                for c in range(3):
+                    out[i, j, c] = np.uint8(alpha * colors[k, c] + (1.0 - alpha) * rgb[i, j, c])
+            else:
+                for c in range(3):
+                    out[i, j, c] = rgb[i, j, c]
+    return out
+
+
+def warm_up():
+    """Kompiliert die Kernel vorab, damit der erste Nutzer nicht auf den JIT wartet"""
+    rgb = np.zeros((2, 2, 3), dtype=np.uint8)
+    mask = np.ones((2, 2), dtype=np.int64)
+    colors = np.zeros((256, 3), dtype=np.float32)
+    blend_mask(rgb, mask, colors, 0.5, np.empty_like(rgb))
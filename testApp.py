@@ -1,28 +1,536 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import leafmap.foliumap as leafmap
 from samgeo import SamGeo
 from samgeo.text_sam import LangSAM
+from segment_anything import SamAutomaticMaskGenerator, SamPredictor
+import contextlib
+import hashlib
+import io
+import math
 import os
+import shutil
+import tempfile
+import threading
 import time
-import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 import geopandas as gpd
 import matplotlib.pyplot as plt
+import mercantile
+import numpy as np
+import rasterio
+import requests
+import torch
+from PIL import Image, ImageDraw
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.profiles import cog_profiles
+from samgeo.common import array_to_image, raster_to_vector
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import fast_ops
 
 # Konfiguration
 st.set_page_config(layout="wide")
 st.title("KI-basierte Objekterkennung mit Meta's LangSAM")
 
+SAM_MODEL_TYPE = "vit_h"
+SAM_KWARGS = {
+    "points_per_side": 32,
+    "pred_iou_thresh": 0.86,
+    "stability_score_thresh": 0.92
+}
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Optionaler ONNX-Encoder (siehe export_sam_onnx.py), aktivieren mit SAM_ONNX_ENCODER=1
+USE_ONNX_ENCODER = os.environ.get("SAM_ONNX_ENCODER") == "1"
+ONNX_ENCODER_PATH = os.path.join("models", "sam_vit_h_encoder.onnx")
+ONNX_PROVIDERS = [
+    ("TensorrtExecutionProvider", {
+        "trt_fp16_enable": True,
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path": os.path.join("models", "trt_cache")
+    }),
+    ("CUDAExecutionProvider", {}),
+    ("OpenVINOExecutionProvider", {}),
+    ("CPUExecutionProvider", {})
+]
+# INT8-Textencoder für GroundingDINO (bitsandbytes, nur GPU), aktivieren mit LANGSAM_INT8=1
+USE_INT8_TEXT_ENCODER = os.environ.get("LANGSAM_INT8") == "1" and DEVICE == "cuda"
+MAP_CENTER = (52.4658, 13.3825)
+TILE_ZOOM = 18
+TILE_SOURCE = "Satellite"
+TILE_SIZE = 256
+TILE_URLS = {
+    "Satellite": "https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}"
+}
+TILE_CACHE_DIR = ".tilecache"
+EMBEDDING_CACHE_DIR = os.path.join(".cache", "embeddings")
+EMBEDDING_CACHE_SIZE = 5
+SESSION_ROOT = os.path.join(tempfile.gettempdir(), "metalangsam")
+SESSION_DIR_MAX_AGE = 24 * 60 * 60
+
+# --- ONNX-Encoder ---
+class OnnxEncoderWrapper(torch.nn.Module):
+    """Ersetzt sam.image_encoder durch eine ONNX-Runtime-Session mit gleicher forward-Signatur"""
+
+    def __init__(self, onnx_path, img_size):
+        super().__init__()
+        import onnxruntime as ort
+
+        self.img_size = img_size
+        available = ort.get_available_providers()
+        self.session = ort.InferenceSession(
+            onnx_path,
+            providers=[provider for provider in ONNX_PROVIDERS if provider[0] in available]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        features = self.session.run(None, {self.input_name: x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(features).to(x.device)
+
+def onnx_encoder_active():
+    """True, wenn der ONNX-Encoder aktiviert und der Export vorhanden ist"""
+    return USE_ONNX_ENCODER and os.path.exists(ONNX_ENCODER_PATH)
+
+def use_onnx_encoder(model):
+    """Tauscht den Bild-Encoder eines SAM-Modells gegen den ONNX-Export, falls aktiviert und vorhanden"""
+    if onnx_encoder_active():
+        model.image_encoder = OnnxEncoderWrapper(ONNX_ENCODER_PATH, model.image_encoder.img_size)
+    return model
+
+# --- Modell-Cache ---
+@st.cache_resource(show_spinner="Lade SAM-Modell...")
+def get_sam_model(model_type):
+    """Lädt das SAM-Netz (inkl. Checkpoint-Download über SamGeo) einmalig; beide Modi teilen es"""
+    model = SamGeo(model_type=model_type, device=DEVICE, automatic=False).sam
+    return use_onnx_encoder(model)
+
+@st.cache_resource(show_spinner=False)
+def get_mask_generator(model_type, kwargs_tuple):
+    """Automatischer Maskengenerator auf dem geteilten SAM-Netz, einmal pro Parametersatz"""
+    return SamAutomaticMaskGenerator(get_sam_model(model_type), **dict(kwargs_tuple))
+
+def quantize_text_encoder(sam):
+    """Ersetzt die nn.Linear-Schichten des GroundingDINO-Textencoders (BERT) durch bitsandbytes-INT8-Schichten"""
+    import bitsandbytes as bnb
+
+    for parent in list(sam.groundingdino.bert.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, torch.nn.Linear):
+                int8 = bnb.nn.Linear8bitLt(
+                    child.in_features,
+                    child.out_features,
+                    bias=child.bias is not None,
+                    has_fp16_weights=False,
+                    threshold=6.0
+                )
+                int8.load_state_dict(child.state_dict())
+                # Die Quantisierung passiert beim Verschieben auf die GPU
+                setattr(parent, name, int8.to(DEVICE))
+    return sam
+
+@st.cache_resource(show_spinner="Lade LangSAM-Modell...")
+def get_langsam():
+    """Lädt LangSAM (GroundingDINO + geteiltes SAM-Netz) einmalig, optional mit INT8-Textencoder"""
+    # LangSAM.__init__ würde ein zweites ViT-H laden; nur GroundingDINO bauen und das SAM-Netz teilen
+    sam = LangSAM.__new__(LangSAM)
+    sam.device = torch.device(DEVICE)
+    sam.build_groundingdino()
+    sam.sam = SamPredictor(get_sam_model(SAM_MODEL_TYPE))
+    if USE_INT8_TEXT_ENCODER:
+        quantize_text_encoder(sam)
+    return sam
+
+@st.cache_resource
+def get_sam_lock():
+    """Prozessweite Sperre für die geteilten SAM-Predictoren (set_image/Decoder ändern deren Zustand)"""
+    return threading.Lock()
+
+def sam_kwargs_key(kwargs):
+    """Hashbarer Cache-Schlüssel für sam_kwargs"""
+    return tuple(sorted(kwargs.items()))
+
+@contextlib.contextmanager
+def inference_context(use_fp16):
+    """torch.inference_mode, auf der GPU optional mit FP16-Autocast"""
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(torch.inference_mode())
+        if use_fp16 and DEVICE == "cuda":
+            # FP16 statt BF16: SAM wandelt Ausgaben per .numpy() um, das kein bfloat16 kennt
+            stack.enter_context(torch.autocast(device_type="cuda", dtype=torch.float16))
+        yield
+
+# --- Paralleler Kachel-Download ---
+def download_tiles_concurrent(bbox, zoom, source, out_path, max_workers=10):
+    """Lädt die XYZ-Kacheln der Bounding Box parallel und schreibt den Ausschnitt als GeoTIFF (EPSG:3857)"""
+    left, bottom, right, top = bbox
+    tiles = list(mercantile.tiles(left, bottom, right, top, zoom))
+    min_x = min(t.x for t in tiles)
+    min_y = min(t.y for t in tiles)
+    cols = max(t.x for t in tiles) - min_x + 1
+    rows = max(t.y for t in tiles) - min_y + 1
+    mosaic = np.zeros((rows * TILE_SIZE, cols * TILE_SIZE, 3), dtype=np.uint8)
+
+    url = TILE_URLS[source]
+    session = requests.Session()
+    session.headers["User-Agent"] = "MetaLangSAM"
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def fetch(tile):
+        response = session.get(url.format(x=tile.x, y=tile.y, z=tile.z), timeout=30)
+        response.raise_for_status()
+        return tile, Image.open(io.BytesIO(response.content)).convert("RGB")
+
+    # Netzwerk läuft in den Threads, das Mosaik wird nur im Hauptthread beschrieben
+    progress = st.progress(0.0, text="Lade Kacheln...")
+    with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch, tile) for tile in tiles]
+        for done, future in enumerate(as_completed(futures), start=1):
+            tile, image = future.result()
+            row = (tile.y - min_y) * TILE_SIZE
+            col = (tile.x - min_x) * TILE_SIZE
+            mosaic[row:row + TILE_SIZE, col:col + TILE_SIZE] = np.asarray(image)
+            progress.progress(done / len(tiles), text=f"Lade Kacheln... {done}/{len(tiles)}")
+    progress.empty()
+
+    # Mosaik auf die Bounding Box zuschneiden
+    origin = mercantile.xy_bounds(min_x, min_y, zoom)
+    res = (origin.right - origin.left) / TILE_SIZE
+    west, south = mercantile.xy(left, bottom)
+    east, north = mercantile.xy(right, top)
+    col_off = int((west - origin.left) / res)
+    row_off = int((origin.top - north) / res)
+    col_end = int(math.ceil((east - origin.left) / res))
+    row_end = int(math.ceil((origin.top - south) / res))
+    image = mosaic[row_off:row_end, col_off:col_end]
+
+    with rasterio.open(
+        out_path, "w",
+        driver="GTiff",
+        height=image.shape[0],
+        width=image.shape[1],
+        count=3,
+        dtype="uint8",
+        crs="EPSG:3857",
+        transform=from_origin(origin.left + col_off * res, origin.top - row_off * res, res, res)
+    ) as dst:
+        dst.write(image.transpose((2, 0, 1)))
+    return out_path
+
+# --- Arbeitsverzeichnis ---
+def session_dir():
+    """Eigenes Arbeitsverzeichnis pro Streamlit-Session, damit parallele Nutzer sich nicht überschreiben"""
+    path = os.path.join(SESSION_ROOT, get_script_run_ctx().session_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def cleanup_session_dirs(max_age=SESSION_DIR_MAX_AGE):
+    """Löscht Arbeitsverzeichnisse, die seit max_age Sekunden nicht mehr geändert wurden (verlassene Sessions)"""
+    if not os.path.isdir(SESSION_ROOT):
+        return
+    now = time.time()
+    for entry in os.scandir(SESSION_ROOT):
+        if entry.is_dir() and now - entry.stat().st_mtime > max_age:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+# --- Kachel-Cache auf der Festplatte ---
+def tile_cache_path(bbox, zoom, source):
+    """Pfad des gecachten GeoTIFFs für (bbox, zoom, source)"""
+    key = hashlib.blake2b(f"{tuple(bbox)}|{zoom}|{source}".encode(), digest_size=16).hexdigest()
+    return os.path.join(TILE_CACHE_DIR, f"{key}.tif")
+
+@st.cache_data(persist="disk", show_spinner=False)
+def get_satellite_tiff(bbox_tuple, zoom, source):
+    """Lädt das Satellitenbild nur, wenn es für diesen Schlüssel noch nicht auf der Festplatte liegt"""
+    cache_path = tile_cache_path(bbox_tuple, zoom, source)
+    if not os.path.exists(cache_path):
+        os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+        # Erst vollständig schreiben, dann umbenennen: kein halbes GeoTIFF im Cache
+        part_path = cache_path + ".part"
+        download_tiles_concurrent(list(bbox_tuple), zoom, source, part_path)
+        os.replace(part_path, cache_path)
+    return cache_path
+
+# --- Kachelweise automatische Segmentierung ---
+def tile_starts(size, tile, overlap):
+    """Startpositionen der Kacheln entlang einer Achse; die letzte Kachel schließt bündig ab"""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, tile - overlap))
+    starts.append(size - tile)
+    return starts
+
+def tiled_generate(mask_generator, tiff_path, mask_path, tile=1024, overlap=128, use_fp16=False):
+    """Wie SamGeo.generate(foreground=True), aber pro rasterio-Fenster statt auf dem ganzen Bild"""
+    with rasterio.open(tiff_path) as src:
+        crs, transform = src.crs, src.transform
+        mask = np.zeros((src.height, src.width), dtype=np.int32)
+        next_id = 1
+
+        for row in tile_starts(src.height, tile, overlap):
+            for col in tile_starts(src.width, tile, overlap):
+                window = Window(col, row, min(tile, src.width - col), min(tile, src.height - row))
+                image = src.read([1, 2, 3], window=window).transpose((1, 2, 0))
+                with get_sam_lock(), inference_context(use_fp16):
+                    anns = mask_generator.generate(image)
+
+                # Große Objekte zuerst, kleinere überdecken sie (wie in samgeo)
+                tile_mask = np.zeros(image.shape[:2], dtype=np.int32)
+                for ann in sorted(anns, key=lambda a: a["area"], reverse=True):
+                    tile_mask[ann["segmentation"]] = next_id
+                    next_id += 1
+
+                # Überlappung per Max-Pooling zusammenführen
+                region = mask[row:row + window.height, col:col + window.width]
+                np.maximum(region, tile_mask, out=region)
+
+    # Kleinster Datentyp wie in SamGeo.save_masks; rasterio.features.shapes kennt kein uint32
+    if next_id <= 256:
+        dtype = "uint8"
+    elif next_id <= 65536:
+        dtype = "uint16"
+    else:
+        dtype = "int32"
+
+    with rasterio.open(
+        mask_path, "w",
+        driver="GTiff",
+        height=mask.shape[0],
+        width=mask.shape[1],
+        count=1,
+        dtype=dtype,
+        crs=crs,
+        transform=transform,
+        nodata=0,
+        compress="deflate"
+    ) as dst:
+        dst.write(mask.astype(dtype), 1)
+    return mask_path
+
+# --- Embedding-Cache ("einmal kodieren, oft prompten") ---
+def load_rgb(tiff_path):
+    """Liest die RGB-Bänder eines GeoTIFFs als (H, W, 3)-Array"""
+    with rasterio.open(tiff_path) as src:
+        return src.read([1, 2, 3]).transpose((1, 2, 0))
+
+def embedding_cache_path(tiff_path, bbox, zoom, source, use_fp16):
+    """Pfad des gespeicherten Embeddings für (bbox, zoom, source, SHA-256 des Bildes, Encoder-Backend)"""
+    with open(tiff_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    key = hashlib.blake2b(
+        f"{tuple(bbox)}|{zoom}|{source}|{digest}|{use_fp16}|{onnx_encoder_active()}".encode(), digest_size=16
+    ).hexdigest()
+    return os.path.join(EMBEDDING_CACHE_DIR, f"{key}.pt")
+
+def evict_embeddings(max_entries=EMBEDDING_CACHE_SIZE):
+    """Löscht die am längsten nicht genutzten Embeddings (LRU über die mtime)"""
+    files = sorted(
+        Path(EMBEDDING_CACHE_DIR).glob("*.pt"), key=lambda path: path.stat().st_mtime, reverse=True
+    )
+    for path in files[max_entries:]:
+        path.unlink(missing_ok=True)
+
+@st.cache_resource(show_spinner="Kodiere Satellitenbild...", max_entries=5)
+def get_image_embedding(tiff_path, bbox_key, zoom, tiff_mtime, use_fp16):
+    """Rechnet den SAM-Encoder einmal pro Bildausschnitt; bbox_key, zoom und tiff_mtime dienen nur als Cache-Schlüssel"""
+    # Gespeichertes Embedding überlebt Tab-Reloads und Neustarts der App
+    cache_pt = embedding_cache_path(tiff_path, bbox_key, zoom, TILE_SOURCE, use_fp16)
+    if os.path.exists(cache_pt):
+        os.utime(cache_pt)
+        return torch.load(cache_pt, map_location=DEVICE)
+
+    predictor = get_langsam().sam
+    image = load_rgb(tiff_path)
+    with get_sam_lock():
+        with inference_context(use_fp16):
+            predictor.set_image(image)
+        embedding = {
+            "features": predictor.features,
+            "input_size": predictor.input_size,
+            "original_size": predictor.original_size
+        }
+
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    torch.save(embedding, cache_pt + ".part")
+    os.replace(cache_pt + ".part", cache_pt)
+    evict_embeddings()
+    return embedding
+
+def restore_embedding(predictor, embedding):
+    """Setzt ein gecachtes Embedding in den SamPredictor, ohne den Encoder laufen zu lassen"""
+    predictor.reset_image()
+    predictor.features = embedding["features"]
+    predictor.input_size = embedding["input_size"]
+    predictor.original_size = embedding["original_size"]
+    predictor.is_image_set = True
+
+def predict_text(sam, image, embedding, text_prompt, box_threshold, text_threshold, use_fp16):
+    """GroundingDINO + SAM-Decoder für einen Prompt auf dem gecachten Embedding"""
+    boxes, _, _ = sam.predict_dino(image, text_prompt, box_threshold, text_threshold)
+
+    if len(boxes) > 0:
+        predictor = sam.sam
+        transformed_boxes = predictor.transform.apply_boxes_torch(boxes, embedding["original_size"])
+        # Setzen und Dekodieren unter einer Sperre, sonst dekodiert eine andere Session gegen das falsche Bild.
+        # Gleicher Kontext wie beim Encoder, sonst passen die FP16-Features nicht zu den Gewichten.
+        with get_sam_lock(), inference_context(use_fp16):
+            restore_embedding(predictor, embedding)
+            masks, _, _ = predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=transformed_boxes.to(predictor.device),
+                multimask_output=False
+            )
+        prediction = masks.squeeze(1).any(dim=0).cpu().numpy().astype(np.uint8) * 255
+    else:
+        prediction = np.zeros((image.height, image.width), dtype=np.uint8)
+
+    return prediction, boxes
+
+def write_prompt_bands(prompt_masks, prompts, output, tiff_path):
+    """Schreibt die Masken aller Prompts als Multiband-GeoTIFF (ein Band pro Prompt)"""
+    with rasterio.open(tiff_path) as src:
+        crs, transform = src.crs, src.transform
+    with rasterio.open(
+        output, "w",
+        driver="GTiff",
+        height=prompt_masks.shape[1],
+        width=prompt_masks.shape[2],
+        count=len(prompts),
+        dtype="uint8",
+        crs=crs,
+        transform=transform,
+        nodata=0,
+        compress="deflate"
+    ) as dst:
+        dst.write(prompt_masks)
+        for band, prompt in enumerate(prompts, start=1):
+            dst.set_band_description(band, prompt)
+
+def predict_prompts(sam, tiff_path, embedding, prompts, box_threshold, text_threshold, output, prompt_output, use_fp16=False):
+    """Ein Encoder-Lauf, pro Prompt nur DINO + Decoder; gibt (Maske, Boxen) zurück, ohne das geteilte Modell zu verändern"""
+    image = Image.fromarray(load_rgb(tiff_path))
+    predictions = [
+        predict_text(sam, image, embedding, prompt, box_threshold, text_threshold, use_fp16)
+        for prompt in prompts
+    ]
+
+    prompt_masks = np.stack([prediction for prediction, _ in predictions])
+    prediction = prompt_masks.max(axis=0)
+    array_to_image(prediction, output, tiff_path, dtype=np.uint8)
+    write_prompt_bands(prompt_masks, prompts, prompt_output, tiff_path)
+
+    boxes = torch.cat([boxes for _, boxes in predictions])
+    return prediction, boxes
+
+# --- Visualisierung ---
+def read_mask(mask_path):
+    """Liest das erste Band einer Masken-GeoTIFF"""
+    with rasterio.open(mask_path) as src:
+        return src.read(1)
+
+@st.cache_resource(show_spinner="Kompiliere Numba-Kernel...")
+def warm_up_kernels():
+    """Kompiliert die Numba-Kernel einmal pro Prozess"""
+    fast_ops.warm_up()
+
+def render_mask_preview(tiff_path, mask_array, cmap_name, out_path, boxes=None, alpha=0.5, max_size=1400):
+    """Blendet die eingefärbte Maske mit dem Numba-Kernel über das Satellitenbild und speichert ein WEBP in Anzeigegröße"""
+    rgb = np.ascontiguousarray(load_rgb(tiff_path))
+    colors = (plt.get_cmap(cmap_name)(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.float32)
+    blended = fast_ops.blend_mask(
+        rgb, mask_array.astype(np.int64), colors, float(alpha), np.empty_like(rgb)
+    )
+
+    # Direkt in Anzeigegröße speichern statt im Browser herunterzurechnen
+    image = Image.fromarray(blended)
+    scale = min(1.0, max_size / max(image.size))
+    if scale < 1.0:
+        image = image.resize(
+            (int(image.width * scale), int(image.height * scale)), Image.BILINEAR
+        )
+    if boxes is not None:
+        draw = ImageDraw.Draw(image)
+        for box in boxes:
+            draw.rectangle([float(v) * scale for v in box], outline="red", width=2)
+    image.save(out_path, "WEBP", quality=85, method=4)
+    return out_path
+
+# --- Vektorisierung ---
+@st.cache_data(show_spinner=False)
+def vectorize(mask_path, mtime, model_flag):
+    """Vektorisiert die Maske nach <name>.gpkg; neu gerechnet wird nur, wenn sich die Maske geändert hat"""
+    vector_path = os.path.splitext(mask_path)[0] + ".gpkg"
+    if not os.path.exists(vector_path) or os.path.getmtime(vector_path) < mtime:
+        # SamGeo/LangSAM.raster_to_vector rufen nur diese Funktion auf, ein Modell ist dafür nicht nötig
+        raster_to_vector(mask_path, vector_path, driver="GPKG", engine="pyogrio")
+    return vector_path
+
+# --- Cloud-Optimized GeoTIFF ---
+def to_cog(path, overview_resampling="nearest"):
+    """Schreibt path als COG (Kacheln, interne Overviews, DEFLATE) nach <name>.cog.tif"""
+    cog_path = os.path.splitext(path)[0] + ".cog.tif"
+    cog_translate(
+        path,
+        cog_path,
+        cog_profiles.get("deflate"),
+        overview_resampling=overview_resampling,
+        in_memory=False,
+        quiet=True
+    )
+    return cog_path
+
+# --- Karten-Cache ---
+@st.cache_data(show_spinner=False)
+def basemap_html(center_tuple, zoom):
+    """HTML der Startkarte mit Satelliten-Basemap, einmal pro Zentrum und Zoomstufe erzeugt"""
+    m = leafmap.Map(center=list(center_tuple), zoom=zoom, height=700)
+    m.add_basemap("SATELLITE")
+    return m.to_html()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def comparison_html(tiff_path, vis_path, mtimes):
+    """HTML des Bildvergleich-Sliders, neu erzeugt nur wenn sich eine der Dateien ändert (mtimes ist nur Cache-Schlüssel)"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_html = os.path.join(tmp_dir, "comparison.html")
+        leafmap.image_comparison(
+            tiff_path,
+            vis_path,
+            label1="Satellitenbild",
+            label2="Segmentierung",
+            starting_position=50,
+            width=700,
+            out_html=out_html
+        )
+        with open(out_html, encoding="utf-8") as f:
+            return f.read()
+
+# --- Export ---
+@st.cache_data(show_spinner=False, max_entries=8)
+def read_bytes(path, mtime):
+    """Liest eine Ergebnisdatei einmal pro Änderungsstand (mtime ist nur Cache-Schlüssel)"""
+    with open(path, "rb") as f:
+        return f.read()
+
+def file_bytes(path):
+    """Dateiinhalt über den read_bytes-Cache"""
+    return read_bytes(path, os.path.getmtime(path))
+
 # Session State für Persistenz
 if 'results' not in st.session_state:
     st.session_state.results = None
 if 'map_visible' not in st.session_state:
     st.session_state.map_visible = True
 
+warm_up_kernels()
+
 # --- 1. Karte initialisieren ---
 if st.session_state.map_visible:
-    m = leafmap.Map(center=[52.4658, 13.3825], zoom=18, height=700)
-    m.add_basemap("SATELLITE")
-    m.to_streamlit(height=500, key="main_map")
+    components.html(basemap_html(MAP_CENTER, TILE_ZOOM), height=500)
 
 # --- 2. Sidebar für Einstellungen ---
 with st.sidebar:
@@ -32,9 +540,15 @@ with st.sidebar:
         ["Automatische Segmentierung", "Text-Prompt Suche"],
         index=0
     )
+    use_fp16 = st.checkbox(
+        "FP16-Inferenz (GPU)",
+        value=DEVICE == "cuda",
+        disabled=DEVICE != "cuda",
+        help="SAM mit torch.autocast in halber Genauigkeit ausführen"
+    )
 
     if process_type == "Text-Prompt Suche":
-        text_prompt = st.text_input("Suchbegriff (Englisch)", "tree")
+        text_prompt = st.text_area("Suchbegriffe (Englisch, kommagetrennt)", "tree")
         box_threshold = st.slider("Box Threshold", 0.0, 1.0, 0.24)
         text_threshold = st.slider("Text Threshold", 0.0, 1.0, 0.24)
 
@@ -51,148 +565,169 @@ st.info(f"Aktuelle Bounding Box: `{bbox}`")
 
 # --- 4. Prozess-Starter ---
 if st.button("Starte Segmentierung", type="primary"):
-    with st.spinner("Lade Satellitenbild..."):
-        tiff_path = "satellite.tif"
-        mask_path = "masks.tif"
-        vector_path = "masks.shp"
-        
-        # Alte Dateien löschen
-        for file in [tiff_path, mask_path, vector_path]:
-            if os.path.exists(file): os.remove(file)
+    cleanup_session_dirs()
+    work_dir = session_dir()
+    tiff_path = os.path.join(work_dir, "satellite.tif")
+    mask_path = os.path.join(work_dir, "masks.tif")
+    vector_path = os.path.join(work_dir, "masks.gpkg")
+    vis_path = os.path.join(work_dir, "visualization.webp")
 
-        # Satellitenbild herunterladen
-        leafmap.map_tiles_to_geotiff(
-            output=tiff_path, bbox=bbox, zoom=18, source="Satellite", overwrite=True
-        )
+    if process_type == "Text-Prompt Suche":
+        prompts = [p.strip() for p in text_prompt.split(",") if p.strip()]
+        if not prompts:
+            st.error("Bitte mindestens einen Suchbegriff eingeben.")
+            st.stop()
+        prompt_mask_path = os.path.join(work_dir, "masks_by_prompt.tif")
 
-    if process_type == "Automatische Segmentierung":
-        # --- Automatische Segmentierung ---
-        with st.spinner("Segmentiere Objekte..."):
-            start_time = time.time()
-            sam = SamGeo(
-                model_type="vit_h",
-                sam_kwargs={
-                    "points_per_side": 32,
-                    "pred_iou_thresh": 0.86,
-                    "stability_score_thresh": 0.92
-                }
-            )
-            sam.generate(tiff_path, output=mask_path, foreground=True)
-            
-            # Erstelle Visualisierung mit Farbpalette
-            fig, ax = plt.subplots(figsize=(12, 12))
-            sam.show_anns(
-                cmap="Greens",
-                box_color="red",
-                title="Automatic Segmentation",
-                blend=True,
-                ax=ax
-            )
-            plt.axis('off')
-            vis_path = "visualization.png"
-            plt.savefig(vis_path, bbox_inches='tight', pad_inches=0)
-            plt.close()
-            
-            duration = time.time() - start_time
-
-        # Ergebnisse speichern
-        st.session_state.results = {
-            'tiff_path': tiff_path,
-            'mask_path': mask_path,
-            'vector_path': vector_path,
-            'vis_path': vis_path,
-            'process_type': process_type,
-            'duration': duration
-        }
+    # Worker-Threads bekommen den Streamlit-Kontext, damit Spinner/Progress aus ihnen funktionieren
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=3, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        # Modell (GPU) lädt parallel zum Download (Netzwerk)
+        if process_type == "Automatische Segmentierung":
+            f_model = executor.submit(get_mask_generator, SAM_MODEL_TYPE, sam_kwargs_key(SAM_KWARGS))
+        else:
+            f_model = executor.submit(get_langsam)
 
-    else:
-        # --- Text-Prompt Segmentierung ---
-        with st.spinner(f"Suche nach '{text_prompt}'..."):
-            start_time = time.time()
-            sam = LangSAM()
-            sam.predict(
-                image=tiff_path,
-                text_prompt=text_prompt,
-                box_threshold=box_threshold,
-                text_threshold=text_threshold,
-                output=mask_path
-            )
-            
-            # Erstelle Visualisierung mit Farbpalette
-            fig, ax = plt.subplots(figsize=(12, 12))
-            sam.show_anns(
-                cmap="Greens",
-                box_color="red",
-                title=f"Segmentation of {text_prompt}",
-                blend=True,
-                ax=ax
-            )
-            plt.axis('off')
-            vis_path = "visualization.png"
-            plt.savefig(vis_path, bbox_inches='tight', pad_inches=0)
-            plt.close()
-            
-            duration = time.time() - start_time
-
-        # Ergebnisse speichern
-        st.session_state.results = {
-            'tiff_path': tiff_path,
-            'mask_path': mask_path,
-            'vector_path': vector_path,
-            'vis_path': vis_path,
-            'process_type': process_type,
-            'text_prompt': text_prompt,
-            'duration': duration,
-            'sam': sam
-        }
+        with st.spinner("Lade Satellitenbild..."):
+            # Alte Ergebnisse löschen (das Satellitenbild wird über den Cache-Schlüssel invalidiert)
+            for file in [mask_path, vector_path]:
+                Path(file).unlink(missing_ok=True)
+
+            # Satellitenbild aus dem Kachel-Cache holen oder herunterladen
+            cache_path = get_satellite_tiff(tuple(bbox), TILE_ZOOM, TILE_SOURCE)
+            if not os.path.exists(cache_path):
+                # Cache-Verzeichnis wurde gelöscht: Memo-Eintrag verwerfen und neu laden
+                get_satellite_tiff.clear()
+                cache_path = get_satellite_tiff(tuple(bbox), TILE_ZOOM, TILE_SOURCE)
+            # Erst kopieren, dann atomar ersetzen: Leser sehen nie ein halbes satellite.tif
+            tmp_path = tiff_path + ".tmp"
+            shutil.copy2(cache_path, tmp_path)
+            os.replace(tmp_path, tiff_path)
+
+        # COG für die Kartenanzeige entsteht parallel zur Segmentierung
+        f_tiff_cog = executor.submit(to_cog, tiff_path, "average")
+
+        if process_type == "Automatische Segmentierung":
+            # --- Automatische Segmentierung ---
+            with st.spinner("Segmentiere Objekte..."):
+                start_time = time.time()
+                mask_generator = f_model.result()
+                tiled_generate(mask_generator, tiff_path, mask_path, use_fp16=use_fp16)
+                
+                # Visualisierung im Thread, Vektorisierung parallel im Hauptthread
+                f_vis = executor.submit(
+                    render_mask_preview, tiff_path, read_mask(mask_path), "Greens", vis_path
+                )
+                f_mask_cog = executor.submit(to_cog, mask_path)
+                vector_path = vectorize(mask_path, os.path.getmtime(mask_path), process_type)
+                f_vis.result()
+                
+                duration = time.time() - start_time
+
+            # Ergebnisse speichern
+            st.session_state.results = {
+                'tiff_path': tiff_path,
+                'tiff_cog_path': f_tiff_cog.result(),
+                'mask_path': mask_path,
+                'mask_cog_path': f_mask_cog.result(),
+                'vector_path': vector_path,
+                'vis_path': vis_path,
+                'process_type': process_type,
+                'duration': duration
+            }
+
+        else:
+            # --- Text-Prompt Segmentierung ---
+            with st.spinner(f"Suche nach {', '.join(repr(p) for p in prompts)}..."):
+                start_time = time.time()
+                sam = f_model.result()
+                # Encoder nur bei neuem Bildausschnitt, Prompt/Thresholds laufen nur durch den Decoder.
+                # Schlüssel ist die Datei im Kachel-Cache, damit Sessions mit gleicher AOI sie teilen.
+                embedding = get_image_embedding(
+                    cache_path, tuple(bbox), TILE_ZOOM, os.path.getmtime(cache_path), use_fp16
+                )
+                prediction, boxes = predict_prompts(
+                    sam,
+                    tiff_path,
+                    embedding,
+                    prompts=prompts,
+                    box_threshold=box_threshold,
+                    text_threshold=text_threshold,
+                    output=mask_path,
+                    prompt_output=prompt_mask_path,
+                    use_fp16=use_fp16
+                )
+                
+                # Visualisierung (inkl. Boxen von GroundingDINO) im Thread, Vektorisierung im Hauptthread
+                f_vis = executor.submit(
+                    render_mask_preview, tiff_path, prediction, "Greens", vis_path, boxes=boxes
+                )
+                f_mask_cog = executor.submit(to_cog, mask_path)
+                vector_path = vectorize(mask_path, os.path.getmtime(mask_path), process_type)
+                f_vis.result()
+                
+                duration = time.time() - start_time
+
+            # Ergebnisse speichern
+            st.session_state.results = {
+                'tiff_path': tiff_path,
+                'tiff_cog_path': f_tiff_cog.result(),
+                'mask_path': mask_path,
+                'mask_cog_path': f_mask_cog.result(),
+                'prompt_mask_path': prompt_mask_path,
+                'vector_path': vector_path,
+                'vis_path': vis_path,
+                'process_type': process_type,
+                'text_prompt': ", ".join(prompts),
+                'duration': duration
+            }
     
     # Karte nach der Prozessierung ausblenden
     st.session_state.map_visible = False
     st.rerun()
 
 # --- 5. Ergebnisse anzeigen (persistent) ---
-if st.session_state.results:
-    results = st.session_state.results
-    
+@st.fragment
+def render_results(results):
+    """Ergebnisansicht; Interaktionen darin starten nur dieses Fragment neu, nicht das ganze Skript"""
     st.success(f"Segmentierung fertig ({results['duration']:.1f}s)")
     st.header(f"Ergebnisse: {results['text_prompt'] if results['process_type'] == 'Text-Prompt Suche' else 'Automatische Segmentierung'}")
     
     # --- Bildvergleich mit Slider ---
     st.subheader("Bildvergleich")
-    leafmap.image_comparison(
+    html = comparison_html(
         results['tiff_path'],
         results['vis_path'],
-        label1="Satellitenbild",
-        label2="Segmentierung",
-        starting_position=50,
-        width=700
+        (os.path.getmtime(results['tiff_path']), os.path.getmtime(results['vis_path']))
     )
+    components.html(html, height=700)
     
     # --- Persistente Karte ---
+    # Reine Darstellungsoption: ändert nur die Karte, keine neue Inferenz
+    opacity = st.slider("Deckkraft der Segmentierung", 0.0, 1.0, 0.7)
     result_map = leafmap.Map(height=700)
-    result_map.add_raster(results['tiff_path'], layer_name="Satellitenbild")
+    # COGs: Tileserver liest nur die benötigten Kacheln/Overviews
+    result_map.add_raster(results['tiff_cog_path'], layer_name="Satellitenbild")
     
     # Farbpalette für Raster festlegen
     palette = "viridis" if results['process_type'] == "Automatische Segmentierung" else "Greens"
     
     result_map.add_raster(
-        results['mask_path'], 
+        results['mask_cog_path'], 
         layer_name="Segmentierung", 
-        opacity=0.7,
+        opacity=opacity,
         palette=palette,
         nodata=0
     )
     
-    # Korrekte Vektorisierung
-    if results['process_type'] == "Text-Prompt Suche":
-        results['sam'].raster_to_vector(results['mask_path'], results['vector_path'])
-    else:
-        sam = SamGeo()
-        sam.raster_to_vector(results['mask_path'], results['vector_path'])
+    # Vektorisierung aus dem Cache: rechnet nur neu, wenn sich die Maske geändert hat
+    vector_path = vectorize(
+        results['mask_path'], os.path.getmtime(results['mask_path']), results['process_type']
+    )
     
     # Vektorlayer mit korrektem Stil
     result_map.add_vector(
-        results['vector_path'], 
+        vector_path, 
         layer_name="Vektorisierte Objekte",
         style={
             "color": "#3388ff",
@@ -204,49 +739,48 @@ if st.session_state.results:
     result_map.add_layer_control()
     result_map.to_streamlit(key="result_map")
 
-    # --- Korrekter Shapefile-Zip Export ---
+    # --- Export ---
     st.header("Ergebnisse exportieren")
     
-    def create_shapefile_zip(shp_path, zip_path):
-        """Erstellt ein korrektes Shapefile-Zip mit allen benötigten Dateien"""
-        base = os.path.splitext(shp_path)[0]
-        extensions = ['.shp', '.shx', '.dbf', '.prj']
+    # Geodaten-Export: Dateien erst nach Bestätigung lesen, nicht bei jedem Rerun
+    if st.checkbox("Downloads vorbereiten"):
+        cols = st.columns(4 if 'prompt_mask_path' in results else 3)
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for ext in extensions:
-                file_path = base + ext
-                if os.path.exists(file_path):
-                    zipf.write(file_path, os.path.basename(file_path))
-    
-    # Geodaten-Export
-    cols = st.columns(3)
-    
-    # GeoTIFF Download
-    cols[0].download_button(
-        label="GeoTIFF herunterladen",
-        data=open(results['mask_path'], "rb"),
-        file_name="segmentation.tif"
-    )
-    
-    # Visualisierung Download
-    cols[1].download_button(
-        label="Visualisierung herunterladen",
-        data=open(results['vis_path'], "rb"),
-        file_name="visualization.png"
-    )
-    
-    # Shapefile Download
-    zip_path = "segmentation_shp.zip"
-    create_shapefile_zip(results['vector_path'], zip_path)
-    
-    cols[2].download_button(
-        label="Vektordaten (Shapefile)",
-        data=open(zip_path, "rb"),
-        file_name="segmentation_shp.zip"
-    )
+        # GeoTIFF Download
+        cols[0].download_button(
+            label="GeoTIFF herunterladen",
+            data=file_bytes(results['mask_path']),
+            file_name="segmentation.tif"
+        )
+        
+        # Visualisierung Download
+        cols[1].download_button(
+            label="Visualisierung herunterladen",
+            data=file_bytes(results['vis_path']),
+            file_name="visualization.webp"
+        )
+        
+        # GeoPackage Download (eine Datei, kein Zip nötig)
+        cols[2].download_button(
+            label="Vektordaten (GeoPackage)",
+            data=file_bytes(vector_path),
+            file_name="segmentation.gpkg"
+        )
+        
+        # Multiband-GeoTIFF (ein Band pro Suchbegriff)
+        if 'prompt_mask_path' in results:
+            cols[3].download_button(
+                label="GeoTIFF pro Suchbegriff",
+                data=file_bytes(results['prompt_mask_path']),
+                file_name="segmentation_by_prompt.tif"
+            )
     
-    # Reset-Button
+    # Reset-Button (st.rerun startet hier das ganze Skript neu)
     if st.button("Neue Segmentierung starten"):
+        shutil.rmtree(session_dir(), ignore_errors=True)
         st.session_state.results = None
         st.session_state.map_visible = True
-        st.rerun()
\ No newline at end of file
+        st.rerun()
+
+if st.session_state.results:
+    render_results(st.session_state.results)
\ No newline at end of file